@@ -1,8 +1,16 @@
 import streamlit as st
 import pandas as pd
 import numpy as np
+import xxhash
+import xlsxwriter
 import io
-from datetime import timedelta
+import contextvars
+import re
+from concurrent.futures import ThreadPoolExecutor
+from charset_normalizer import from_bytes
+from numba import njit
+from pandas.tseries.api import guess_datetime_format
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 
 # --- Page Configuration ---
 st.set_page_config(page_title="Auto-BRS Tool", layout="wide")
@@ -11,44 +19,101 @@ st.title("🏦 Smart Bank Reconciliation System")
 
 # --- Helper Functions ---
 
-def clean_currency(x):
-    """Removes commas, 'Dr', 'Cr' and converts to float."""
-    if isinstance(x, str):
-        clean_str = x.replace(',', '').replace(' Dr', '').replace(' Cr', '').strip()
-        try:
-            return float(clean_str) if clean_str else 0.0
-        except ValueError:
-            return 0.0
-    return x if x else 0.0
+HEADER_DATE_RE = re.compile(r'date', re.I)
+HEADER_KEYWORD_RE = re.compile(r'narration|debit|credit|withdraw|deposit|vch|particulars', re.I)
+CURRENCY_JUNK_RE = re.compile(r'[,\s]|Dr|Cr')
+
+def clean_currency(series):
+    """Removes commas, 'Dr', 'Cr' and converts a column to float."""
+    # Excel cells and comma-free CSV amounts already arrive as numbers
+    if pd.api.types.is_numeric_dtype(series):
+        return series.fillna(0.0).astype('float64')
+    
+    clean_str = series.astype(str).str.replace(CURRENCY_JUNK_RE, '', regex=True)
+    return pd.to_numeric(clean_str, errors='coerce').fillna(0.0)
 
 def parse_dates(series):
     """Attempts to convert a column to datetime objects safely."""
-    return pd.to_datetime(series, dayfirst=True, errors='coerce')
+    if pd.api.types.is_datetime64_any_dtype(series):
+        return series
+    
+    # Guess one layout from the first parseable cells and apply it column-wide
+    fmt = None
+    for value in series.dropna().astype(str).str.strip().head(5):
+        fmt = guess_datetime_format(value, dayfirst=True)
+        if fmt:
+            break
+    if fmt:
+        dates = pd.to_datetime(series, format=fmt, errors='coerce')
+        if dates.notna().sum() == series.notna().sum():
+            return dates
+    # Columns that mix layouts fall back to parsing each cell on its own
+    return pd.to_datetime(series, format='mixed', dayfirst=True, errors='coerce')
 
-def load_data(uploaded_file):
-    """Smart loader that checks file extension first."""
-    if uploaded_file is None:
-        return None
-        
-    filename = uploaded_file.name.lower()
+def dedupe_names(names):
+    """Suffixes repeated column names with .1, .2, ... the way pd.read_excel does."""
+    taken = set(names)
+    seen = set()
+    next_suffix = {}
+    unique = []
+    for name in names:
+        if name in seen:
+            # Skip suffixes that another header cell already uses
+            k = next_suffix.get(name, 1)
+            while f"{name}.{k}" in taken:
+                k += 1
+            next_suffix[name] = k + 1
+            name = f"{name}.{k}"
+            taken.add(name)
+        seen.add(name)
+        unique.append(name)
+    return unique
+
+def content_key(data):
+    """Fast content hash used as the st.cache_data key for upload bytes."""
+    return xxhash.xxh3_128_hexdigest(data)
+
+# The caches are shared by every session, so bound them: each entry holds a
+# user's parsed statement, and results should not outlive a working session.
+@st.cache_data(show_spinner=False, max_entries=16, ttl="1h")
+def load_data_bytes(file_key, _file_bytes, name):
+    """Smart loader that checks file extension first, then finds the header row.
+
+    Cached on `file_key` (see content_key); the leading underscore keeps
+    Streamlit from hashing the raw bytes again on every call.
+    """
+    file_bytes = _file_bytes
+    buffer = io.BytesIO(file_bytes)
+    filename = name.lower()
+    is_excel = filename.endswith(('.xlsx', '.xls'))
     df_raw = None
+    used_encoding = None
     
     try:
-        # 1. Strict Excel Check
-        if filename.endswith(('.xlsx', '.xls')):
-            uploaded_file.seek(0)
-            df_raw = pd.read_excel(uploaded_file)
+        # 1. Strict Excel Check (parsed once; the header row is promoted below)
+        if is_excel:
+            # calamine (Rust) reads .xlsx and .xls far faster than the default
+            # engines; fall back to them if python-calamine is not installed
+            try:
+                df_raw = pd.read_excel(buffer, header=None, engine='calamine')
+            except ImportError:
+                buffer.seek(0)
+                df_raw = pd.read_excel(buffer, header=None)
             
         # 2. Strict CSV Check
         elif filename.endswith('.csv'):
-            encodings = ['utf-8', 'ISO-8859-1', 'cp1252']
-            for enc in encodings:
-                try:
-                    uploaded_file.seek(0)
-                    df_raw = pd.read_csv(uploaded_file, encoding=enc)
-                    break
-                except:
-                    continue
+            # Only the head of the file is needed to find the header; cut it
+            # on a line boundary so no row or multi-byte character is split.
+            head = file_bytes[:65536]
+            if len(file_bytes) > len(head) and b'\n' in head:
+                head = head[:head.rfind(b'\n') + 1]
+            
+            # Sniff the encoding once on the sample instead of re-parsing per guess
+            best = from_bytes(head).best()
+            used_encoding = best.encoding if best else 'utf-8'
+            if used_encoding == 'ascii':
+                used_encoding = 'utf-8'  # rows past the sample may not be pure ASCII
+            df_raw = pd.read_csv(io.BytesIO(head), encoding=used_encoding, encoding_errors='replace', nrows=50, header=None, on_bad_lines='skip')
         else:
             st.error("Unsupported file format. Please use .csv or .xlsx")
             return None
@@ -62,29 +127,318 @@ def load_data(uploaded_file):
         return None
 
     # 3. Find the Header Row (Auto-detection)
-    header_idx = -1
-    for i, row in df_raw.iterrows():
-        row_str = row.astype(str).str.lower().tolist()
+    # Look for "Date" AND ("Narration" OR "Debit" OR "Credit" OR "Withdraw" OR "Deposit")
+    row_text = df_raw.head(50).astype(str).fillna('').agg(' '.join, axis=1)
+    has_date = row_text.str.contains(HEADER_DATE_RE)
+    has_keyword = row_text.str.contains(HEADER_KEYWORD_RE)
+    
+    header_hits = (has_date & has_keyword).to_numpy()
+    header_idx = int(header_hits.argmax()) if header_hits.any() else 0
+    
+    # 4. Excel: promote the header row of the already-parsed sheet
+    if is_excel:
+        header = df_raw.iloc[header_idx]
+        df = df_raw.iloc[header_idx + 1:].reset_index(drop=True)
+        df.columns = dedupe_names([str(c).strip() if pd.notna(c) else f"Unnamed: {i}" for i, c in enumerate(header)])
+        return df.infer_objects()
+    
+    # 5. CSV: single full read with the detected header row
+    try:
+        buffer.seek(0)
+        # PyArrow parses multithreaded, but counts blank lines when skipping to
+        # the header (the C engine does not), so only use it when they agree.
+        if not any(not line.strip() for line in head.splitlines()[:header_idx]):
+            try:
+                df = pd.read_csv(buffer, header=header_idx, encoding=used_encoding, engine='pyarrow')
+                # PyArrow keeps blank header cells as '' and repeated names as-is;
+                # leave those to the C engine's "Unnamed: n" / ".1" renaming.
+                if df.columns.is_unique and all(df.columns):
+                    return df
+            except Exception:
+                pass
+            buffer.seek(0)
+        return pd.read_csv(buffer, header=header_idx, encoding=used_encoding, encoding_errors='replace', thousands=',')
+    except Exception as e:
+        st.error(f"Error loading file: {e}")
+        return None
+
+def day_numbers(dates):
+    """Returns (whole days since epoch as int64, not-NaT mask) for a datetime column."""
+    days = dates.to_numpy().astype('datetime64[D]')
+    return days.astype(np.int64), ~np.isnat(days)
+
+@njit(cache=True)
+def free_slot(link, k):
+    """Follows skip pointers from slot `k` to the nearest free slot, compressing the path."""
+    root = k
+    while link[root] != root:
+        root = link[root]
+    while link[k] != root:
+        nxt = link[k]
+        link[k] = root
+        k = nxt
+    return root
+
+@njit(cache=True)
+def assign_matches(dated, undated, packed, rows, bank_day, book_day, lo, mid, hi,
+                   all_rows, glo, ghi, n_bank):
+    """Greedy one-to-one matching in ledger order; returns each row's bank row or -1.
+
+    Dated ledger rows take the closest free bank row in their packed window
+    [lo, hi) of `packed` (bank order on ties); undated ones take the first free
+    bank row of their group in `all_rows`. Skip pointers jump over taken rows,
+    so no candidate pairs are materialised.
+    """
+    n = len(rows)
+    # Skip pointers over the dated slots: nxt leads to the next free slot at or
+    # after k (n if none); prv, shifted by one, to the last free one before k.
+    nxt = np.arange(n + 1)
+    prv = np.arange(n + 1)
+    nxt_all = np.arange(n_bank + 1)
+    slot = np.full(n_bank, -1)
+    slot_all = np.empty(n_bank, dtype=np.int64)
+    for k in range(n):
+        slot[rows[k]] = k
+    for k in range(n_bank):
+        slot_all[all_rows[k]] = k
+    
+    match = np.full(len(dated), -1)
+    for i in range(len(dated)):
+        j = -1
+        if dated[i]:
+            best_diff = -1
+            # Closest free slot on or after the ledger date...
+            k = free_slot(nxt, mid[i])
+            if k < hi[i]:
+                j, best_diff = rows[k], bank_day[rows[k]] - book_day[i]
+            # ...against the lowest bank row on the closest earlier free day
+            p = free_slot(prv, mid[i]) - 1
+            if p >= lo[i]:
+                q = free_slot(nxt, np.searchsorted(packed, packed[p]))
+                diff = book_day[i] - bank_day[rows[q]]
+                if j < 0 or diff < best_diff or (diff == best_diff and rows[q] < j):
+                    j = rows[q]
+        elif undated[i]:
+            k = free_slot(nxt_all, glo[i])
+            if k < ghi[i]:
+                j = all_rows[k]
+        if j < 0:
+            continue
+        match[i] = j
+        a = slot_all[j]
+        nxt_all[a] = a + 1
+        d = slot[j]
+        if d >= 0:
+            nxt[d] = d + 1
+            prv[d + 1] = d
+    return match
+
+def prepare_statement(df, source, inflow, outflow, types):
+    """Maps amount/date columns and adds the fields used for matching, in place.
+
+    `inflow`/`outflow` are (column name, keywords) pairs. A row's Match_Amount
+    is its inflow when positive, else its outflow, and its Type is the
+    categorical types[0] or types[1] accordingly. Returns (frame, date column
+    or None).
+    """
+    in_name, in_keywords = inflow
+    out_name, out_keywords = outflow
+    
+    df.columns = df.columns.str.strip()
+    cols_lower = [c.lower() for c in df.columns]
+    
+    # Smart Column Mapping
+    in_idx = next((i for i, c in enumerate(cols_lower) if any(x in c for x in in_keywords)), None)
+    out_idx = next((i for i, c in enumerate(cols_lower) if any(x in c for x in out_keywords)), None)
+    date_idx = next((i for i, c in enumerate(cols_lower) if 'date' in c), None)
+    
+    if in_idx is None or out_idx is None:
+        st.error(f"Could not find Amount columns in {source}. Looked for: {'/'.join(in_keywords + out_keywords)}")
+        st.write("Columns found:", df.columns.tolist())
+        st.stop()
+    
+    in_col = df.columns[in_idx]
+    out_col = df.columns[out_idx]
+    date_col = df.columns[date_idx] if date_idx is not None else None
+    
+    # `df` is the caller's private copy (st.cache_data hands out a fresh one),
+    # so add the working columns in place rather than duplicating every column
+    clean = df
+    clean[in_name] = clean_currency(clean[in_col])
+    clean[out_name] = clean_currency(clean[out_col])
+    
+    if date_col:
+        clean['Date_Obj'] = parse_dates(clean[date_col])
+    else:
+        clean['Date_Obj'] = pd.NaT
+
+    is_inflow = clean[in_name].to_numpy() > 0
+    clean['Match_Amount'] = np.where(is_inflow, clean[in_name].to_numpy(), clean[out_name].to_numpy())
+    clean['Type'] = pd.Categorical(np.where(is_inflow, types[0], types[1]), categories=list(types))
+    clean['Matched'] = False
+    return clean, date_col
+
+def reconcile(book_clean, bank_clean, date_col, b_date_col, date_tolerance):
+    """Greedily pairs each ledger row with the closest-dated unmatched bank row.
+
+    Marks the `Matched` flag on both frames in place and returns the matched
+    pairs as a DataFrame.
+    """
+    match = np.full(len(book_clean), -1)
+    
+    if not book_clean.empty and not bank_clean.empty:
+        # Group rows by (side, amount). Type codes line up across frames: 0 is
+        # money in (Receipt/Deposit), 1 is money out (Payment/Withdrawal).
+        # Amounts are compared as exact integer cents, kept local so the key
+        # does not show up in the unmatched tabs or the report.
+        book_cents = np.rint(book_clean['Match_Amount'].to_numpy() * 100).astype(np.int64)
+        bank_cents = np.rint(bank_clean['Match_Amount'].to_numpy() * 100).astype(np.int64)
+        book_key = book_cents * 2 + book_clean['Type'].cat.codes.to_numpy()
+        bank_key = bank_cents * 2 + bank_clean['Type'].cat.codes.to_numpy()
+        _, group = np.unique(np.concatenate([book_key, bank_key]), return_inverse=True)
+        book_grp, bank_grp = group[:len(book_key)], group[len(book_key):]
+        book_day, book_dated = day_numbers(book_clean['Date_Obj'])
+        bank_day, bank_dated = day_numbers(bank_clean['Date_Obj'])
+        live = book_cents != 0
         
-        # Look for "Date" AND ("Narration" OR "Debit" OR "Credit" OR "Withdraw" OR "Deposit")
-        has_date = any("date" in s for s in row_str)
-        has_keyword = any(k in s for s in row_str for k in ['narration', 'debit', 'credit', 'withdraw', 'deposit', 'vch', 'particulars'])
+        # Dated ledger rows search dated bank rows packed as (group, day) and
+        # sorted with bank order on ties, so each date window is one range.
+        wanted = np.flatnonzero(live & book_dated)
+        rows = np.flatnonzero(bank_dated) if len(wanted) else np.empty(0, dtype=np.int64)
+        packed = np.empty(0, dtype=np.int64)
+        lo, mid, hi = (np.zeros(len(book_key), dtype=np.int64) for _ in range(3))
+        if len(rows):
+            days = np.concatenate([book_day[wanted], bank_day[rows]])
+            base = days.min() - date_tolerance
+            width = days.max() - base + date_tolerance + 1
+            packed = bank_grp[rows] * width + (bank_day[rows] - base)
+            order = np.lexsort((rows, packed))
+            rows, packed = rows[order], packed[order]
+            centre = book_grp[wanted] * width + (book_day[wanted] - base)
+            lo[wanted] = np.searchsorted(packed, centre - date_tolerance, 'left')
+            mid[wanted] = np.searchsorted(packed, centre, 'left')
+            hi[wanted] = np.searchsorted(packed, centre + date_tolerance, 'right')
         
-        if has_date and has_keyword:
-            header_idx = i
-            break
+        # Undated ledger rows may take any bank row of their group, in bank order
+        all_rows = np.argsort(bank_grp, kind='stable')
+        grp_sorted = bank_grp[all_rows]
+        glo = np.searchsorted(grp_sorted, book_grp, 'left')
+        ghi = np.searchsorted(grp_sorted, book_grp, 'right')
+        
+        # One-to-one assignment in ledger order, closest date first and
+        # bank order on ties
+        match = assign_matches(
+            live & book_dated, live & ~book_dated, packed, rows, bank_day, book_day,
+            lo, mid, hi, all_rows, glo, ghi, len(bank_key),
+        )
     
-    # 4. Reload with correct header if needed
-    if header_idx != -1:
-        # If headers are not in the first row, we must reload
-        uploaded_file.seek(0)
-        if filename.endswith(('.xlsx', '.xls')):
-            return pd.read_excel(uploaded_file, header=header_idx+1)
-        else:
-            # Re-read CSV with identified encoding (assuming 'utf-8' fallback if unknown)
-            return pd.read_csv(uploaded_file, header=header_idx+1, encoding='ISO-8859-1') # fallback encoding
+    book_pos = np.flatnonzero(match >= 0)
+    bank_pos = match[book_pos]
+    book_matched = match >= 0
+    bank_matched = np.zeros(len(bank_clean), dtype=bool)
+    bank_matched[bank_pos] = True
     
-    return df_raw
+    book_clean['Matched'] = book_matched
+    bank_clean['Matched'] = bank_matched
+    
+    # Narration Matching
+    book_narr_col = next((c for c in book_clean.columns if 'narration' in c.lower() or 'account' in c.lower()), None)
+    bank_narr_col = next((c for c in bank_clean.columns if 'narration' in c.lower()), None)
+    
+    def take(df, col, pos, as_text=False):
+        if col is None:
+            return ''
+        values = df[col].to_numpy()[pos]
+        return values.astype(str) if as_text else values
+    
+    return pd.DataFrame({
+        'Amount': book_clean['Match_Amount'].to_numpy()[book_pos],
+        'Type': book_clean['Type'].to_numpy()[book_pos],
+        'Book_Date': take(book_clean, date_col, book_pos),
+        'Bank_Date': take(bank_clean, b_date_col, bank_pos),
+        'Book_Ref': take(book_clean, book_narr_col, book_pos, as_text=True),
+        'Bank_Ref': take(bank_clean, bank_narr_col, bank_pos, as_text=True),
+    })
+
+def build_report(matched_df, unmatched_book, unmatched_bank):
+    """Serializes the reconciliation results into Excel workbook bytes."""
+    buffer = io.BytesIO()
+    # constant_memory flushes each row as it is written instead of holding the
+    # whole sheet and its shared strings in RAM; rows must go out in order.
+    workbook = xlsxwriter.Workbook(buffer, {
+        'constant_memory': True,
+        'strings_to_urls': False,
+        'default_date_format': 'yyyy-mm-dd hh:mm:ss',
+    })
+    header_fmt = workbook.add_format({'bold': True, 'border': 1, 'align': 'center', 'valign': 'top'})
+    for sheet_name, df in [
+        ('Matched', matched_df),
+        ('Missing_in_Bank', unmatched_book),
+        ('Missing_in_Books', unmatched_bank),
+    ]:
+        sheet = workbook.add_worksheet(sheet_name)
+        sheet.write_row(0, 0, [str(c) for c in df.columns], header_fmt)
+        # Plain Python cells with blanks as None, which xlsxwriter skips, and
+        # infinities spelled out as to_excel's inf_rep did (write_number rejects them)
+        cells = df.astype(object).where(df.notna(), None).replace({np.inf: 'inf', -np.inf: '-inf'})
+        for row_num, row in enumerate(cells.itertuples(index=False, name=None), start=1):
+            sheet.write_row(row_num, 0, row)
+    workbook.close()
+    return buffer.getvalue()
+
+@st.cache_data(show_spinner=False, max_entries=8, ttl="1h")
+def run_reconciliation(book_key, _book_bytes, book_name, bank_key, _bank_bytes, bank_name, date_tolerance):
+    """Loads, preprocesses and reconciles both uploads end to end.
+
+    Cached on the files' content keys, names and the tolerance so reruns from
+    tab switches or downloads reuse the results. Returns (matched, unmatched ledger rows,
+    unmatched bank rows, report bytes), or None if either file failed to load.
+    """
+    # The two parses are independent; PyArrow releases the GIL while parsing,
+    # so overlap them. Workers inherit the script context so st.error works,
+    # and run in a copy of this call's contextvars so st.cache_data records
+    # their messages for replay on this function's cache hits too.
+    with ThreadPoolExecutor(2, initializer=add_script_run_ctx, initargs=(None, get_script_run_ctx())) as ex:
+        book_future = ex.submit(contextvars.copy_context().run, load_data_bytes, book_key, _book_bytes, book_name)
+        bank_future = ex.submit(contextvars.copy_context().run, load_data_bytes, bank_key, _bank_bytes, bank_name)
+        df_book, df_bank = book_future.result(), bank_future.result()
+    if df_book is None or df_bank is None:
+        return None
+
+    # --- Preprocessing ---
+    try:
+        book_clean, date_col = prepare_statement(
+            df_book, "Ledger", ('Debit', ['debit', 'deposit']), ('Credit', ['credit', 'withdraw']),
+            ('Receipt', 'Payment'),
+        )
+    except Exception as e:
+        st.error(f"Error processing Ledger: {e}")
+        st.stop()
+
+    try:
+        bank_clean, b_date_col = prepare_statement(
+            df_bank, "Bank Statement", ('Deposit', ['deposit', 'credit']), ('Withdrawal', ['withdraw', 'debit']),
+            ('Deposit', 'Withdrawal'),
+        )
+    except Exception as e:
+        st.error(f"Error processing Bank: {e}")
+        st.stop()
+
+    # --- RECONCILIATION ENGINE ---
+    matched_df = reconcile(book_clean, bank_clean, date_col, b_date_col, date_tolerance)
+
+    # Build each side of the diff once and share it between the tabs and the report
+    unmatched_book = book_clean[~book_clean['Matched'].to_numpy()]
+    unmatched_bank = bank_clean[~bank_clean['Matched'].to_numpy()]
+    return matched_df, unmatched_book, unmatched_bank, build_report(matched_df, unmatched_book, unmatched_bank)
+
+def show_table(df, limit=1000):
+    """Renders at most `limit` rows; every tab is sent to the browser on each rerun."""
+    if len(df) > limit:
+        st.dataframe(df.head(limit))
+        st.caption(f"Showing first {limit:,} of {len(df):,} rows. Download the report for the full list.")
+    else:
+        st.dataframe(df)
 
 # --- Main App Logic ---
 
@@ -104,155 +458,29 @@ with col2:
 
 if ledger_file and bank_file:
     st.divider()
+    st.info(f"Reconciling... (Tolerance: {date_tolerance} days)")
     
-    # 1. Load Data
-    df_book = load_data(ledger_file)
-    df_bank = load_data(bank_file)
-
-    if df_book is not None and df_bank is not None:
-        
-        # --- Preprocessing Ledger (Book) ---
-        try:
-            df_book.columns = df_book.columns.str.strip()
-            cols_lower = [c.lower() for c in df_book.columns]
-            
-            # Smart Column Mapping
-            debit_idx = next((i for i, c in enumerate(cols_lower) if any(x in c for x in ['debit', 'deposit'])), None)
-            credit_idx = next((i for i, c in enumerate(cols_lower) if any(x in c for x in ['credit', 'withdraw'])), None)
-            date_idx = next((i for i, c in enumerate(cols_lower) if 'date' in c), None)
-            
-            if debit_idx is None or credit_idx is None:
-                st.error("Could not find Amount columns in Ledger. Looked for: Debit/Credit/Deposits/Withdrawals")
-                st.write("Columns found:", df_book.columns.tolist())
-                st.stop()
-            
-            debit_col = df_book.columns[debit_idx]
-            credit_col = df_book.columns[credit_idx]
-            date_col = df_book.columns[date_idx] if date_idx is not None else None
-                
-            book_clean = df_book.copy()
-            book_clean['Debit'] = book_clean[debit_col].apply(clean_currency).fillna(0)
-            book_clean['Credit'] = book_clean[credit_col].apply(clean_currency).fillna(0)
-            
-            if date_col:
-                book_clean['Date_Obj'] = parse_dates(book_clean[date_col])
-            else:
-                book_clean['Date_Obj'] = pd.NaT
-
-            book_clean['Match_Amount'] = book_clean.apply(
-                lambda x: x['Debit'] if x['Debit'] > 0 else x['Credit'], axis=1
-            )
-            book_clean['Type'] = book_clean.apply(
-                lambda x: 'Receipt' if x['Debit'] > 0 else 'Payment', axis=1
-            )
-            book_clean['Matched'] = False
-            
-        except Exception as e:
-            st.error(f"Error processing Ledger: {e}")
-            st.stop()
-
-        # --- Preprocessing Bank Statement ---
-        try:
-            df_bank.columns = df_bank.columns.str.strip()
-            cols_lower = [c.lower() for c in df_bank.columns]
-            
-            w_idx = next((i for i, c in enumerate(cols_lower) if any(x in c for x in ['withdraw', 'debit'])), None)
-            d_idx = next((i for i, c in enumerate(cols_lower) if any(x in c for x in ['deposit', 'credit'])), None)
-            date_idx = next((i for i, c in enumerate(cols_lower) if 'date' in c), None)
-            
-            if w_idx is None or d_idx is None:
-                st.error("Could not find Amount columns in Bank Statement.")
-                st.write("Columns found:", df_bank.columns.tolist())
-                st.stop()
-            
-            w_col = df_bank.columns[w_idx]
-            d_col = df_bank.columns[d_idx]
-            b_date_col = df_bank.columns[date_idx] if date_idx is not None else None
-            
-            bank_clean = df_bank.copy()
-            bank_clean['Withdrawal'] = bank_clean[w_col].apply(clean_currency).fillna(0)
-            bank_clean['Deposit'] = bank_clean[d_col].apply(clean_currency).fillna(0)
-            
-            if b_date_col:
-                bank_clean['Date_Obj'] = parse_dates(bank_clean[b_date_col])
-            else:
-                bank_clean['Date_Obj'] = pd.NaT
-
-            bank_clean['Match_Amount'] = bank_clean.apply(
-                lambda x: x['Deposit'] if x['Deposit'] > 0 else x['Withdrawal'], axis=1
-            )
-            bank_clean['Type'] = bank_clean.apply(
-                lambda x: 'Deposit' if x['Deposit'] > 0 else 'Withdrawal', axis=1
-            )
-            bank_clean['Matched'] = False
-            
-        except Exception as e:
-            st.error(f"Error processing Bank: {e}")
-            st.stop()
+    book_bytes, bank_bytes = ledger_file.getvalue(), bank_file.getvalue()
+    result = run_reconciliation(
+        content_key(book_bytes), book_bytes, ledger_file.name,
+        content_key(bank_bytes), bank_bytes, bank_file.name,
+        date_tolerance,
+    )
 
-        # --- RECONCILIATION ENGINE ---
-        st.info(f"Reconciling... (Tolerance: {date_tolerance} days)")
-        
-        matches = []
+    if result is not None:
+        matched_df, unmatched_book, unmatched_bank, report_bytes = result
         
-        for i, book_row in book_clean.iterrows():
-            amt = book_row['Match_Amount']
-            book_date = book_row['Date_Obj']
-            
-            if amt == 0: continue
-            
-            b_type = book_row['Type']
-            
-            if b_type == 'Receipt':
-                candidates = bank_clean[
-                    (bank_clean['Type'] == 'Deposit') & 
-                    (np.isclose(bank_clean['Match_Amount'], amt, atol=0.01)) & 
-                    (bank_clean['Matched'] == False)
-                ]
-            else: 
-                candidates = bank_clean[
-                    (bank_clean['Type'] == 'Withdrawal') & 
-                    (np.isclose(bank_clean['Match_Amount'], amt, atol=0.01)) & 
-                    (bank_clean['Matched'] == False)
-                ]
-            
-            valid_candidates = candidates
-            if pd.notna(book_date) and not candidates.empty:
-                candidates['days_diff'] = (candidates['Date_Obj'] - book_date).abs().dt.days
-                valid_candidates = candidates[candidates['days_diff'] <= date_tolerance]
-                if not valid_candidates.empty:
-                    valid_candidates = valid_candidates.sort_values('days_diff')
-
-            if not valid_candidates.empty:
-                bank_idx = valid_candidates.index[0]
-                book_clean.at[i, 'Matched'] = True
-                bank_clean.at[bank_idx, 'Matched'] = True
-                
-                # Narration Matching
-                book_narr = str(book_row.get(next((c for c in df_book.columns if 'narration' in c.lower() or 'account' in c.lower()), 'Narration'), ''))
-                bank_narr = str(bank_clean.at[bank_idx, next((c for c in df_bank.columns if 'narration' in c.lower()), 'Narration')] if next((c for c in df_bank.columns if 'narration' in c.lower()), None) else '')
-
-                matches.append({
-                    'Amount': amt,
-                    'Type': b_type,
-                    'Book_Date': book_row.get(date_col, ''),
-                    'Bank_Date': bank_clean.at[bank_idx, b_date_col] if b_date_col else '',
-                    'Book_Ref': book_narr,
-                    'Bank_Ref': bank_narr
-                })
-
         # --- Results ---
-        st.success(f"Reconciliation Complete! {len(matches)} matched.")
+        st.success(f"Reconciliation Complete! {len(matched_df)} matched.")
         
         tab1, tab2, tab3 = st.tabs(["✅ Matched", "⚠️ Missing in Bank", "⚠️ Missing in Books"])
-        with tab1: st.dataframe(pd.DataFrame(matches))
-        with tab2: st.dataframe(book_clean[book_clean['Matched'] == False])
-        with tab3: st.dataframe(bank_clean[bank_clean['Matched'] == False])
+        with tab1: show_table(matched_df)
+        with tab2: show_table(unmatched_book)
+        with tab3: show_table(unmatched_bank)
         
-        buffer = io.BytesIO()
-        with pd.ExcelWriter(buffer, engine='xlsxwriter') as writer:
-            pd.DataFrame(matches).to_excel(writer, sheet_name='Matched', index=False)
-            book_clean[book_clean['Matched'] == False].to_excel(writer, sheet_name='Missing_in_Bank', index=False)
-            bank_clean[bank_clean['Matched'] == False].to_excel(writer, sheet_name='Missing_in_Books', index=False)
-            
-        st.download_button("📥 Download Report", buffer, "BRS_Report.xlsx")
+        st.download_button(
+            "📥 Download Report",
+            report_bytes,
+            "BRS_Report.xlsx",
+            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        )